@@ -10,54 +10,125 @@ import os
 import time
 import tempfile
 import shutil
-import subprocess
 import logging
 import pickle
+import json
+import functools
 from bisect import bisect_right, bisect_left
+from itertools import zip_longest
 from inotify_simple import INotify, flags
+import ocrmypdf
+import pikepdf
 import argparse
+import queue
+import threading
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 
 MON_DIR = '/input'
 OUT_DIR = '/out'
+STATE_FILE = os.path.join(OUT_DIR, '.meta.json')
+# State file of older versions, only read to migrate from it
 PICKLE_FILE = os.path.join(OUT_DIR, '.meta')
+# Results being written, renamed to their final name once complete
+INCOMING_PREFIX = '.incoming-'
+# Tesseract handles several languages in one pass
+OCR_LANG = 'eng+deu'
+# Plain pdf skips the Ghostscript PDF/A conversion
+OUTPUT_TYPE = 'pdf'
+# Max seconds between two scans of the same 2-sided document
+COLLATE_WINDOW = 60
+# Max seconds between directory scans, when polling without --poll-interval
+POLL_INTERVAL = 30
+# Polling delays in seconds, see poll_loop
+POLL_START_DELAY = 0.1
+POLL_MIN_DELAY = 0.01
+POLL_BACKOFF = 1.5
 
 logging.basicConfig(level=logging.INFO)
+# Same as ocrmypdf -q
+logging.getLogger('ocrmypdf').setLevel(logging.WARNING)
 
 class NonFatalError(Exception):
     """Processing failed only for one file, we can continue"""
 
+def is_pdf(fname):
+    """Only pdfs are processed, scanners and we leave other files around.
+    Hidden ones are usually still being written under a temporary name"""
+    return not fname.startswith('.') and fname.lower().endswith('.pdf')
+
+def fsync_dir(path):
+    """Make renames within a directory survive a crash"""
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+@functools.lru_cache(maxsize=128)
+def out_name(out, date_iso, lang, collated):
+    """Generate a name for result"""
+    collated_str = ""
+    if collated:
+        collated_str = "_collated"
+
+    out_base_name = os.path.join(out, date_iso)
+
+    return "%s_%s%s.pdf" % (out_base_name, lang, collated_str)
+
 class Pdf:
     """Represents one input pdf file"""
 
-    def __init__(self, name, prev):
+    def __init__(self, name, prev, mtime=None):
         self.name = name
-        mtime = os.path.getmtime(name)
+        if mtime is None:
+            mtime = os.path.getmtime(name)
+        self.mtime_ts = mtime
         self.mtime = datetime.fromtimestamp(mtime)
         self.prev = prev
         self.out = None
         self.timestamp = self.mtime.strftime("%Y-%m-%dT%H_%M_%S")
+        self._date_iso = self.mtime.date().isoformat()
+
+    def to_dict(self):
+        """Minimal state needed to continue after this file"""
+        return {
+            "name": self.name,
+            # Exact float, a local time string is ambiguous around DST
+            "mtime": self.mtime_ts,
+            # Only for humans reading the file
+            "mtime_iso": self.mtime.isoformat(),
+            "out": self.out,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        """Restore a pdf saved with to_dict"""
+        pdf = cls(state["name"], None, state["mtime"])
+        pdf.out = state["out"]
+        return pdf
 
     def get_new_out_dir_name(self):
         """Find a new home for results"""
-        out = os.path.join(OUT_DIR, self.timestamp)
-        if os.path.exists(out):
+        with os.scandir(OUT_DIR) as entries:
+            existing = {entry.name for entry in entries}
+
+        out = self.timestamp
+        if out in existing:
             for i in range(1, 11):
-                test_name = "%s_%02d" % (out, i)
-                if not os.path.exists(test_name):
+                test_name = "%s_%02d" % (self.timestamp, i)
+                if test_name not in existing:
                     out = test_name
                     break
 
-        if os.path.exists(out):
+        if out in existing:
             logging.error("Too many files with mtime %s", self.timestamp)
             raise NonFatalError()
-        return out
+        return os.path.join(OUT_DIR, out)
 
     def get_out_name(self, lang, out_dir=None, collated=False):
         """Generate a name for result"""
-        collated_str = ""
-        if collated:
-            collated_str = "_collated"
-
         if out_dir:
             out = out_dir
         elif self.out:
@@ -65,161 +136,281 @@ class Pdf:
         else:
             raise ValueError("No output directory")
 
-        out_base_name = os.path.join(out, self.mtime.date().isoformat())
+        return out_name(out, self._date_iso, lang, collated)
 
-        return "%s_%s%s.pdf" % (out_base_name, lang, collated_str)
-
-    def ocr(self, out_dir):
+    def ocr(self, out_dir, jobs=None):
         """Generate a pdf with ocr layer"""
-        for lang in ("eng", "deu"):
-            ocr_cmd = [
-                "ocrmypdf",
-                "-q",
-                self.name,
-                "-l", lang,
-                "--",
-                self.get_out_name(lang, out_dir=out_dir)
-            ]
-            try:
-                subprocess.check_call(ocr_cmd)
-            except subprocess.CalledProcessError:
-                logging.error("Failed to ocrmypdf: %s", " ".join(ocr_cmd))
-                raise NonFatalError
+        ocr_out = self.get_out_name(OCR_LANG, out_dir=out_dir)
+        try:
+            result = ocrmypdf.ocr(self.name, ocr_out,
+                                  language=OCR_LANG.split('+'),
+                                  output_type=OUTPUT_TYPE,
+                                  jobs=jobs,
+                                  # Do not fork this process for page
+                                  # workers, tesseract is exec'd anyway
+                                  use_threads=True,
+                                  progress_bar=False)
+        except Exception:
+            # In-process, a broken input raises whatever went wrong
+            logging.exception("Failed to ocrmypdf %s", self.name)
+            raise NonFatalError
+        if result != ocrmypdf.ExitCode.ok:
+            logging.error("Failed to ocrmypdf %s: %s", self.name, result)
+            raise NonFatalError
 
         return True
 
     def collate(self):
         """Collate this pdf with the previous one"""
-        for lang in ("eng", "deu"):
-            collate_cmd = [
-                "qpdf", "--collate", "--empty",
-                "--pages",
-                self.prev.get_out_name(lang),
-                self.get_out_name(lang),
-                "z-1", "--",
-                self.prev.get_out_name(lang, collated=True)
-            ]
-
-            try:
-                subprocess.check_call(collate_cmd)
-            except subprocess.CalledProcessError:
-                logging.error("Failed to collate: %s", " ".join(collate_cmd))
-                raise NonFatalError
-
-    def process(self):
+        front_name = self.prev.get_out_name(OCR_LANG)
+        back_name = self.get_out_name(OCR_LANG)
+        try:
+            with pikepdf.open(front_name) as front, \
+                    pikepdf.open(back_name) as back, \
+                    pikepdf.new() as collated:
+                # Back sides are scanned starting from the last page
+                for pages in zip_longest(front.pages, reversed(back.pages)):
+                    for page in pages:
+                        if page is not None:
+                            collated.pages.append(page)
+                collated.save(self.prev.get_out_name(OCR_LANG, collated=True))
+        except (pikepdf.PdfError, OSError):
+            logging.error("Failed to collate %s with %s", front_name, back_name)
+            raise NonFatalError
+
+    def process(self, jobs=None):
         """Process one input file"""
-        temp_dir = tempfile.mkdtemp()
+        # Stay on the same filesystem, so the result is published by a rename
+        temp_dir = tempfile.mkdtemp(dir=OUT_DIR, prefix=INCOMING_PREFIX)
         try:
-            self.ocr(temp_dir)
+            self.ocr(temp_dir, jobs)
             self.out = self.get_new_out_dir_name()
-            shutil.move(temp_dir, self.out)
+            os.rename(temp_dir, self.out)
         except:
             shutil.rmtree(temp_dir)
             raise
+        fsync_dir(OUT_DIR)
 
         if self.prev is None:
             return
 
-        if (self.mtime - self.prev.mtime).seconds > 60:
+        # An older file (e.g. moved in with its mtime kept) is never a back side
+        if not 0 <= self.mtime_ts - self.prev.mtime_ts <= COLLATE_WINDOW:
             return
         self.collate()
 
-def process_one_file(fname, prev):
+def process_one_file(fname, prev, jobs=None):
     """Process one input file"""
     logging.info("processing %s", fname)
     name = os.path.join(MON_DIR, fname)
 
-    for i in range(10):
-        if not os.path.exists(name):
-            raise NonFatalError()
-        
-        if os.path.getsize(name) != 0:
-            break
-        logging.warning("File %s has zero length. It probably has not been written yet. Retry after 5 senconds", fname)
-        time.sleep(5)
-
-    pdf = Pdf(name, prev)
-    pdf.process()
+    stat = os.stat(name)
+    if stat.st_size == 0:
+        logging.warning("File %s has zero length, skipping", fname)
+        raise NonFatalError()
+
+    pdf = Pdf(name, prev, stat.st_mtime)
+    pdf.process(jobs)
     if prev:
         prev.prev = None
-    save_latest(pdf)
     logging.info("file %s is done", fname)
     return pdf
 
+def remove_incoming():
+    """Remove results left behind by a run which was killed in the middle"""
+    with os.scandir(OUT_DIR) as entries:
+        for entry in entries:
+            if entry.name.startswith(INCOMING_PREFIX) and entry.is_dir():
+                logging.warning("removing unfinished result %s", entry.path)
+                shutil.rmtree(entry.path)
+
 def save_latest(pdf):
     """Save the state of the tool. If crashed or updated we will start
     from where we left it"""
-    with open(PICKLE_FILE, 'wb') as cache_f:
-        pickle.dump(pdf, cache_f)
+    tmp_file = STATE_FILE + '.tmp'
+    with open(tmp_file, 'w') as state_f:
+        json.dump(pdf.to_dict(), state_f)
+        state_f.flush()
+        os.fsync(state_f.fileno())
+    os.replace(tmp_file, STATE_FILE)
+    fsync_dir(os.path.dirname(STATE_FILE))
 
 def load_latest():
     """Load the state from the previous run"""
-    ret = None
-    if not os.path.exists(PICKLE_FILE):
-        return None
-
-    with open(PICKLE_FILE, 'rb') as cache_f:
-        ret = pickle.load(cache_f)
-
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE) as state_f:
+            return Pdf.from_dict(json.load(state_f))
+
+    if os.path.exists(PICKLE_FILE):
+        with open(PICKLE_FILE, 'rb') as cache_f:
+            old = pickle.load(cache_f)
+        # Old pickles only have the attributes older versions set
+        pdf = Pdf(old.name, None, old.mtime.timestamp())
+        pdf.out = old.out
+        return pdf
+
+    return None
+
+def is_newer(pdf, latest_pdf):
+    """Whether pdf should replace latest_pdf as the point to continue from.
+    Files moved in with an old mtime must not move it back, or the next
+    rescan would process everything after them again"""
+    return latest_pdf is None or pdf.mtime_ts > latest_pdf.mtime_ts
+
+def process_segment(names, prev, jobs=None, save=False):
+    """Process files one by one, collating each with the previous one if
+    needed. Return the newest processed pdf"""
+    ret = prev
+    for name in names:
+        try:
+            prev = process_one_file(name, prev, jobs)
+        except (NonFatalError, FileNotFoundError):
+            logging.error("Failed processing %s", name)
+            continue
+        if is_newer(prev, ret):
+            ret = prev
+            if save:
+                save_latest(ret)
     return ret
 
 def process_offline_files(latest_pdf):
     """Process files which were created while the tool was not running"""
-    ret = latest_pdf
-
-    files = []
-    for filename in os.listdir(MON_DIR):
-        cur_mtime = os.path.getmtime(os.path.join(MON_DIR, filename))
-        cur_mtime = datetime.fromtimestamp(cur_mtime)
-        files.append((cur_mtime, filename))
-    files = sorted(files, key=lambda f: f[0])
-
-    # Keep only files older then last_pdf
-    keys = [x[0] for x in files]
-
-    if latest_pdf and latest_pdf.mtime >= files[-1][0]:
-        return latest_pdf
+    with os.scandir(MON_DIR) as entries:
+        files = [(entry.stat().st_mtime, entry.name)
+                 for entry in entries if entry.is_file() and is_pdf(entry.name)]
+    files.sort()
 
+    # Keep only files newer then last_pdf
     if latest_pdf:
-        i = 0
-        if len(keys) >= 2:
-            i = bisect_right(keys, latest_pdf.mtime)
-        if files[i][1] == os.path.basename(latest_pdf.name):
+        i = bisect_right(files, latest_pdf.mtime_ts, key=itemgetter(0))
+        if i < len(files) and files[i][1] == os.path.basename(latest_pdf.name):
             i += 1
+        if i >= len(files):
+            return latest_pdf
         files = files[i:]
 
-    for cur_file in files:
-        name = cur_file[1]
-        try:
-            ret = process_one_file(name, ret)
-        except (NonFatalError, FileNotFoundError):
-            logging.error("Failed processing %s", name)
-            continue
+    return process_files(files, latest_pdf)
+
+def process_files(files, latest_pdf):
+    """Process (mtime, name) pairs sorted by mtime, return the latest pdf"""
+    ret = latest_pdf
+
+    # Files close to each other may have to be collated, so they have to be
+    # processed one after another. Everything else can go in parallel.
+    segments = []
+    last_mtime = None
+    for cur_mtime, name in files:
+        if segments and cur_mtime - last_mtime <= COLLATE_WINDOW:
+            segments[-1].append(name)
+        else:
+            segments.append([name])
+        last_mtime = cur_mtime
+
+    if len(segments) <= 1:
+        for names in segments:
+            ret = process_segment(names, ret, save=True)
+        return ret
+
+    cpus = os.cpu_count() or 1
+    workers = min(len(segments), max(1, cpus // 2))
+    jobs = max(1, cpus // workers)
+    # Workers come from a forkserver rather than a fork of this process,
+    # which may be running the inotify reader thread. The forkserver has
+    # ocrmypdf loaded already, so workers do not import it again.
+    mp_context = multiprocessing.get_context('forkserver')
+    mp_context.set_forkserver_preload(['ocrmypdf', 'pikepdf'])
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as pool:
+        # Only the first segment may continue the previously processed file
+        futures = [pool.submit(process_segment, names, ret if i == 0 else None, jobs)
+                   for i, names in enumerate(segments)]
+        for future in futures:
+            pdf = future.result()
+            if pdf is not None and is_newer(pdf, ret):
+                ret = pdf
+                save_latest(ret)
     return ret
 
-def inotify_loop():
+def read_events(inotify, events):
+    """Move inotify events to a queue, so the kernel one does not fill up
+    while a file is being processed"""
+    while True:
+        for event in inotify.read():
+            if event.mask & flags.Q_OVERFLOW or is_pdf(event.name):
+                events.put(event)
+
+def inotify_loop(latest_pdf):
+    prev_pdf = latest_pdf
     inotify = INotify()
-    watch_flags = flags.CREATE
+    # Only react once the writer is done with the file
+    watch_flags = flags.CLOSE_WRITE | flags.MOVED_TO
     inotify.add_watch(MON_DIR, watch_flags)
 
+    events = queue.SimpleQueue()
+    reader = threading.Thread(target=read_events, args=(inotify, events),
+                              daemon=True)
+    reader.start()
+
+    # Files of the last batch, name -> mtime
+    last_batch = {}
+
     logging.info("entering inotify loop")
     while True:
-        for event in inotify.read():
+        # Take everything which arrived while the previous batch was busy
+        batch = [events.get()]
+        while not events.empty():
+            batch.append(events.get_nowait())
+
+        # Events were lost, the directory is all we have
+        if any(event.mask & flags.Q_OVERFLOW for event in batch):
+            logging.warning("inotify queue overflow, rescanning %s", MON_DIR)
+            prev_pdf = process_offline_files(prev_pdf)
+            continue
+
+        # Several events for the same file count as one
+        files = []
+        for name in {event.name for event in batch}:
             try:
-                prev_pdf = process_one_file(event.name, prev_pdf)
-            except (NonFatalError, FileNotFoundError):
-                logging.error("Failed processing %s", event.name)
+                mtime = os.stat(os.path.join(MON_DIR, name)).st_mtime
+            except FileNotFoundError:
+                logging.error("Failed processing %s", name)
+                continue
+            # A late event for a file the previous batch already did, and
+            # which was not changed since
+            if last_batch.get(name) == mtime:
                 continue
+            files.append((mtime, name))
+        if not files:
+            continue
+
+        files.sort()
+        last_batch = {name: mtime for mtime, name in files}
+        prev_pdf = process_files(files, prev_pdf)
 
 def poll_loop(interval, latest_pdf):
     logging.info("entering polling loop")
+    # Poll often right after something arrived, and back off towards
+    # interval while nothing happens
+    delay = POLL_START_DELAY
+    deadline = time.monotonic()
     while True:
-        time.sleep(interval)
+        deadline += delay
+        sleep_time = deadline - time.monotonic()
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+        else:
+            # Previous round took longer than the delay, go on right away
+            deadline -= sleep_time
         try:
-            latest_pdf = process_offline_files(latest_pdf)
+            new_pdf = process_offline_files(latest_pdf)
         except (NonFatalError, FileNotFoundError):
-            logging.error("Failed processing %s", event.name)
-            continue
+            logging.error("Failed processing offline files")
+            new_pdf = latest_pdf
+
+        if new_pdf is not latest_pdf:
+            delay = POLL_MIN_DELAY
+        else:
+            delay = min(delay * POLL_BACKOFF, interval)
+        latest_pdf = new_pdf
 
 def main():
     """Where all the things start"""
@@ -227,21 +418,24 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--inotify", default=True,
                         help="Register inotify event instead of polling filesystem")
-    parser.add_argument("--poll-interval", default=0, type=int,
-                        help="How often to look for new files")
+    parser.add_argument("--poll-interval", default=None, type=int, metavar="N",
+                        help="Poll instead of using inotify, at most N seconds apart")
     args = parser.parse_args()
+    if args.poll_interval is not None and args.poll_interval <= 0:
+        parser.error("--poll-interval must be positive")
 
     print(args.inotify)
 
+    remove_incoming()
     prev_pdf = load_latest()
     if prev_pdf:
         logging.info("restored state. Latest processed file is %s", prev_pdf.name)
     prev_pdf = process_offline_files(prev_pdf)
 
-    if not args.inotify or args.poll_interval > 0:
-        poll_loop(args.poll_interval, prev_pdf)
+    if not args.inotify or args.poll_interval:
+        poll_loop(args.poll_interval or POLL_INTERVAL, prev_pdf)
     else:
-        inotify_loop()
+        inotify_loop(prev_pdf)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
-from datetime import datetime
 import subprocess
 import logging
 import os
 import shutil
 import argparse
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 INPUT_DIR = '/input'
 OUT_DIR = '/output'
 ARCHIVE_DIR = '/archive'
+# Max seconds between directory scans
+POLL_INTERVAL = 30
+# Polling delays in seconds, see poll_loop
+POLL_START_DELAY = 0.1
+POLL_MIN_DELAY = 0.01
+POLL_BACKOFF = 1.5
 
 logging.basicConfig(level=logging.INFO)
 
@@ -35,46 +41,65 @@ def collate(front, back, output):
         logging.error("Failed to collate: %s", " ".join(collate_cmd))
         raise NonFatalError
 
+def collate_pair(pair):
+    """Collate two input files and archive them, return True on success"""
+    front, back = (os.path.join(INPUT_DIR, name) for _, name in pair)
+    output = os.path.join(OUT_DIR, os.path.basename(front))
+    try:
+        collate(front, back, output)
+        shutil.move(front, ARCHIVE_DIR)
+        shutil.move(back, ARCHIVE_DIR)
+    except (NonFatalError, FileNotFoundError):
+        logging.error("Failed processing %s", back)
+        return False
+    return True
+
 def process():
-    files = []
-    for filename in os.listdir(INPUT_DIR):
-        cur_mtime = os.path.getmtime(os.path.join(INPUT_DIR, filename))
-        cur_mtime = datetime.fromtimestamp(cur_mtime)
-        files.append((cur_mtime, filename))
-    files = sorted(files, key=lambda f: f[0])
+    """Collate pairs of input files, return how many were done"""
+    with os.scandir(INPUT_DIR) as entries:
+        files = [(entry.stat().st_mtime, entry.name)
+                 for entry in entries if entry.is_file()]
+    files.sort()
 
-    front = None
-    for cur_file in files:
-        name = os.path.join(INPUT_DIR, cur_file[1])
-        if front:
-            try:
-                output = os.path.basename(front)
-                output = os.path.join(OUT_DIR, output)
-                collate(front, name, output)
-                shutil.move(front, ARCHIVE_DIR)
-                shutil.move(name, ARCHIVE_DIR)
-                front = None
-            except (NonFatalError, FileNotFoundError):
-                logging.error("Failed processing %s", name)
-                continue
-        front = name
+    # Pairs do not depend on each other. An odd file out waits for its
+    # other half to show up.
+    pairs = zip(files[::2], files[1::2])
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        return sum(pool.map(collate_pair, pairs))
 
 def poll_loop(interval):
     logging.info("entering polling loop")
+    # Poll often right after something arrived, and back off towards
+    # interval while nothing happens
+    delay = POLL_START_DELAY
+    deadline = time.monotonic()
     while True:
-        time.sleep(interval)
+        deadline += delay
+        sleep_time = deadline - time.monotonic()
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+        else:
+            # Previous round took longer than the delay, go on right away
+            deadline -= sleep_time
         try:
-            process()
+            processed = process()
         except (NonFatalError, FileNotFoundError):
-            logging.error("Failed processing %s", event.name)
-            continue
+            logging.error("Failed processing files")
+            processed = 0
+
+        if processed:
+            delay = POLL_MIN_DELAY
+        else:
+            delay = min(delay * POLL_BACKOFF, interval)
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--poll-interval", default=0, type=int,
-                        help="How often to look for new files")
+    parser.add_argument("--poll-interval", default=POLL_INTERVAL, type=int,
+                        help="Max seconds between looking for new files")
     args = parser.parse_args()
+    if args.poll_interval <= 0:
+        parser.error("--poll-interval must be positive")
 
     poll_loop(args.poll_interval)
 
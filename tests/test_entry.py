@@ -0,0 +1,41 @@
+import os
+import pickle
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("inotify_simple")
+pytest.importorskip("ocrmypdf")
+pytest.importorskip("pikepdf")
+
+import entry
+
+
+def test_load_latest_migrates_old_pickle(tmp_path, monkeypatch):
+    monkeypatch.setattr(entry, "STATE_FILE", str(tmp_path / ".meta.json"))
+    monkeypatch.setattr(entry, "PICKLE_FILE", str(tmp_path / ".meta"))
+
+    # What Pdf.__init__ used to set, before the state moved to JSON
+    mtime = datetime(2021, 3, 4, 5, 6, 7)
+    old = entry.Pdf.__new__(entry.Pdf)
+    old.__dict__.update(
+        name="/input/scan.pdf",
+        mtime=mtime,
+        prev=None,
+        out="/out/2021-03-04T05_06_07",
+        timestamp=mtime.strftime("%Y-%m-%dT%H_%M_%S"),
+    )
+    with open(entry.PICKLE_FILE, "wb") as cache_f:
+        pickle.dump(old, cache_f)
+
+    pdf = entry.load_latest()
+    assert pdf.name == old.name
+    assert pdf.mtime == mtime
+    assert pdf.out == old.out
+
+    # The migrated state round-trips through the new format
+    entry.save_latest(pdf)
+    os.remove(entry.PICKLE_FILE)
+    restored = entry.load_latest()
+    assert restored.to_dict() == pdf.to_dict()
+    assert restored.mtime_ts == mtime.timestamp()